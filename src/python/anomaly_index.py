@@ -0,0 +1,367 @@
+"""
+anomaly_index.py
+----------------
+Online anomaly scoring of new readings against cached forecast intervals.
+
+This module:
+1. Keeps, per (data center, metric), the latest forecast interval (history +
+   24-month horizon) and in-sample residual statistics in a compact index
+   persisted to data/processed/anomaly_index.npz (rebuilt by forecast.py each night).
+2. Scores incoming readings — a single month or a daily feed — in constant time
+   per point: month lookup, interval check and a Severity value. Readings at or
+   before a series' last scored date are skipped, so re-running a file is safe.
+3. Appends flagged readings to forecast_anomalies.csv with the same columns as
+   the batch run, so the Anomaly Count / Severity Index KPIs update within seconds.
+4. Tracks drift with an EWMA of monthly standardized residuals (clipped, so one
+   outlier is not drift); series that drift, or whose readings fall outside the
+   cached horizon, are refit on the spot.
+
+Usage:
+    python src/python/anomaly_index.py new_readings.csv [--no-refit]
+
+Author: Kenneth @ TippleK Data Centres
+"""
+
+import argparse
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+# --- Project Paths ---
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+INDEX_FILE = os.path.join(PROJECT_ROOT, "data/processed/anomaly_index.npz")
+ANOMALIES_FILE = os.path.join(PROJECT_ROOT, "data/processed/forecast_anomalies.csv")
+ENRICHED_FILE = os.path.join(PROJECT_ROOT, "data/enriched/enriched_monthly.csv")
+
+# Output schema shared with forecast.detect_anomalies
+ANOMALY_COLUMNS = ["ds", "y", "yhat", "yhat_lower", "yhat_upper", "Anomaly", "Severity", "Metric", "Data_Center_Name"]
+
+# Raw Monthly_Validated columns etl.enrich needs to derive the other metrics
+RAW_COLUMNS = ["Reserved_Racks", "Decommissioned_Racks", "Total_Contracted_Racks", "Avg_IT_Load_kW", "Avg_Total_Load_kW"]
+
+INDEX_HORIZON = 24       # months of forecast cached beyond the last fitted month
+DRIFT_SMOOTHING = 0.3    # EWMA weight of the newest month's standardized residual
+DRIFT_Z_CLIP = 3.0       # cap on one month's |z|, so a single outlier cannot raise the alarm alone
+# Alarm at 3 standard deviations of the EWMA under no drift; with the clip this
+# takes at least two consecutive same-sign months far outside the usual residuals
+DRIFT_LIMIT = 3 * math.sqrt(DRIFT_SMOOTHING / (2 - DRIFT_SMOOTHING))
+
+
+def severity(y, yhat, yhat_lower, yhat_upper):
+    """
+    Distance from the forecast, in units of the interval half-width on that side.
+    0 = on the forecast, 1 = on the interval bound, > 1 = outside (anomaly).
+    """
+    y, yhat = np.asarray(y, dtype="float64"), np.asarray(yhat, dtype="float64")
+    half_width = np.where(y >= yhat, np.asarray(yhat_upper) - yhat, yhat - np.asarray(yhat_lower))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(half_width > 0, np.abs(y - yhat) / half_width, np.where(y == yhat, 0.0, np.inf))
+
+
+def _month(ds):
+    """Months since 1970-01 for a date or array of dates."""
+    return np.asarray(ds, dtype="datetime64[M]").astype("int64")
+
+
+# Per-series drift state persisted with the index
+DRIFT_FIELDS = ("drift_ewma", "drift_base", "drift_month", "month_resid_sum", "month_count")
+
+
+NO_READING = np.iinfo("int64").min   # last_scored of a series with nothing scored yet
+
+
+def _already_scored(entry, ds):
+    return int(np.datetime64(ds, "ns").astype("int64")) <= entry["last_scored"]
+
+
+def _fresh_drift():
+    """Drift state of a newly fitted series."""
+    return {"drift_ewma": 0.0, "drift_base": 0.0, "drift_month": -1, "month_resid_sum": 0.0, "month_count": 0}
+
+
+class AnomalyIndex:
+    """
+    Cached forecast intervals and residual statistics per (DC, metric).
+
+    Each entry holds dense monthly arrays (yhat, yhat_lower, yhat_upper) starting
+    at first_month, so a reading is scored by one subtraction and one array lookup.
+    """
+
+    def __init__(self, series=None):
+        self.series = series or {}   # (dc, metric) -> entry dict
+        self.stale = set()           # series that received readings beyond their cached horizon
+
+    # --- Construction ---
+    @classmethod
+    def build(cls, store, forecasts):
+        """
+        Build entries from forecast frames {(dc, metric): frame with ds/yhat/yhat_lower/yhat_upper}
+        and the history held in a SeriesStore.
+        """
+        series = {}
+        for (dc, metric), fc in forecasts.items():
+            if fc is None or fc.empty:
+                continue
+            months = _month(fc["ds"].to_numpy())
+            first = int(months.min())
+            length = int(months.max()) - first + 1
+
+            # Dense monthly arrays; months missing from the forecast stay NaN
+            arrays = {}
+            for col in ("yhat", "yhat_lower", "yhat_upper"):
+                dense = np.full(length, np.nan)
+                dense[months - first] = fc[col].to_numpy(dtype="float64")
+                arrays[col] = dense
+
+            # In-sample residuals on the history the model was fitted on
+            hist_ds, hist_y = store.series(dc, metric)
+            hist_pos = _month(hist_ds) - first
+            inside = (hist_pos >= 0) & (hist_pos < length)
+            resid = hist_y[inside] - arrays["yhat"][hist_pos[inside]]
+            resid = resid[~np.isnan(resid)]
+
+            series[(dc, metric)] = {
+                "first_month": first,
+                **arrays,
+                "resid_mean": float(resid.mean()) if len(resid) else 0.0,
+                "resid_std": float(resid.std()) if len(resid) > 1 else float("nan"),
+                # Readings on or before the fitted history are never scored online
+                "last_scored": int(hist_ds[-1].astype("datetime64[ns]").astype("int64")) if len(hist_ds) else NO_READING,
+                **_fresh_drift(),
+            }
+        return cls(series)
+
+    def update(self, other):
+        """Replace entries with freshly fitted ones (drift resets with the refit)."""
+        for key, entry in other.series.items():
+            if key in self.series:
+                # Keep the online position: readings scored before the refit are not scored
+                # again, while the ones that triggered it (now in the refit history) still are
+                entry["last_scored"] = self.series[key]["last_scored"]
+            self.series[key] = entry
+        self.stale -= set(other.series)
+
+    # --- Persistence ---
+    def save(self, path=INDEX_FILE):
+        """Persist as one npz: concatenated interval arrays plus per-series offsets and stats."""
+        keys = list(self.series)
+        entries = [self.series[k] for k in keys]
+        lengths = np.array([len(e["yhat"]) for e in entries], dtype="int64")
+        stats = ("first_month", "resid_mean", "resid_std", "last_scored", *DRIFT_FIELDS)
+
+        def cat(col):
+            return np.concatenate([e[col] for e in entries]) if entries else np.empty(0)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(
+            path,
+            dc=np.array([k[0] for k in keys], dtype="U"),
+            metric=np.array([k[1] for k in keys], dtype="U"),
+            length=lengths,
+            yhat=cat("yhat"),
+            yhat_lower=cat("yhat_lower"),
+            yhat_upper=cat("yhat_upper"),
+            stale=np.array([k in self.stale for k in keys], dtype=bool),
+            **{s: np.array([e[s] for e in entries]) for s in stats},
+        )
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        # Materialize once: NpzFile re-reads an array from disk on every key access
+        with np.load(path) as npz:
+            data = dict(npz)
+        offsets = np.concatenate([[0], np.cumsum(data["length"])])
+        series, stale = {}, set()
+        for i, key in enumerate(zip(data["dc"].tolist(), data["metric"].tolist())):
+            window = slice(offsets[i], offsets[i + 1])
+            series[key] = {
+                "first_month": int(data["first_month"][i]),
+                "yhat": data["yhat"][window],
+                "yhat_lower": data["yhat_lower"][window],
+                "yhat_upper": data["yhat_upper"][window],
+                "resid_mean": float(data["resid_mean"][i]),
+                "resid_std": float(data["resid_std"][i]),
+                "last_scored": int(data["last_scored"][i]) if "last_scored" in data else NO_READING,
+                # Drift state; indexes saved before it was tracked per month start fresh
+                **{f: type(v)(data[f][i]) if f in data else v for f, v in _fresh_drift().items()},
+            }
+            if data["stale"][i]:
+                stale.add(key)
+        index = cls(series)
+        index.stale = stale
+        return index
+
+    # --- Online scoring ---
+    def score(self, dc, metric, ds, y):
+        """
+        Score one reading in O(1). Returns an ANOMALY_COLUMNS row dict, or None
+        when the series is unknown, the reading was already scored (at or before
+        the series' last scored date) or the date is outside the cached interval.
+        """
+        entry = self.series.get((dc, metric))
+        if entry is None or y is None or np.isnan(y) or _already_scored(entry, ds):
+            return None
+        pos = int(_month(ds)) - entry["first_month"]
+        if not 0 <= pos < len(entry["yhat"]) or np.isnan(entry["yhat"][pos]):
+            self.stale.add((dc, metric))
+            return None
+
+        yhat = entry["yhat"][pos]
+        lower, upper = entry["yhat_lower"][pos], entry["yhat_upper"][pos]
+        sev = float(severity(y, yhat, lower, upper))
+
+        # Drift: one EWMA step per month, fed the month's mean residual standardized by the
+        # monthly in-sample spread (interval half-width, then 1.0, when missing or zero).
+        # A daily feed therefore moves the EWMA like one monthly reading, on the scale the
+        # residuals were measured on, and re-scoring within a month replaces that step.
+        month = pos + entry["first_month"]
+        if month != entry["drift_month"]:
+            entry["drift_base"] = entry["drift_ewma"]
+            entry["drift_month"] = month
+            entry["month_resid_sum"], entry["month_count"] = 0.0, 0
+        entry["month_resid_sum"] += y - yhat - entry["resid_mean"]
+        entry["month_count"] += 1
+
+        for scale in (entry["resid_std"], (upper - lower) / 2, 1.0):
+            if np.isfinite(scale) and scale > 0:
+                break
+        z = np.clip(entry["month_resid_sum"] / entry["month_count"] / scale, -DRIFT_Z_CLIP, DRIFT_Z_CLIP)
+        entry["drift_ewma"] = (1 - DRIFT_SMOOTHING) * entry["drift_base"] + DRIFT_SMOOTHING * float(z)
+        entry["last_scored"] = int(np.datetime64(ds, "ns").astype("int64"))
+
+        return {
+            "ds": pd.Timestamp(ds), "y": y, "yhat": yhat, "yhat_lower": lower, "yhat_upper": upper,
+            "Anomaly": sev > 1, "Severity": sev, "Metric": metric, "Data_Center_Name": dc,
+        }
+
+    def score_frame(self, readings: pd.DataFrame):
+        """
+        Score a wide readings frame (Reporting_Date, Data_Center_Name, metric columns).
+        Returns (scored, unscored): unscored holds readings of known series that fell
+        outside the cached interval, in long form (ds, Data_Center_Name, Metric, y),
+        so they can be scored again after a refit.
+        """
+        metrics = sorted({m for _, m in self.series if m in readings.columns})
+        points = pd.concat(
+            [pd.DataFrame({"ds": readings["Reporting_Date"].to_numpy(dtype="datetime64[ns]"),
+                           "Data_Center_Name": readings["Data_Center_Name"].to_numpy(),
+                           "Metric": metric,
+                           "y": readings[metric].to_numpy(dtype="float64")})
+             for metric in metrics],
+            ignore_index=True,
+        ) if metrics else pd.DataFrame(columns=["ds", "Data_Center_Name", "Metric", "y"])
+        return self.score_points(points)
+
+    def score_points(self, points: pd.DataFrame):
+        """
+        Score long-form readings (ds, Data_Center_Name, Metric, y); returns (scored, unscored).
+        Readings are scored in date order; ones already scored by an earlier run are skipped,
+        so re-submitting a file does not append its anomalies or move the drift EWMA twice.
+        """
+        points = points.sort_values("ds", kind="mergesort").reset_index(drop=True)
+        rows, unscored, repeated = [], [], 0
+        for i, (ds, dc, metric, y) in enumerate(zip(points["ds"].to_numpy(), points["Data_Center_Name"],
+                                                     points["Metric"], points["y"].to_numpy(dtype="float64"))):
+            entry = self.series.get((dc, metric))
+            if entry is not None and _already_scored(entry, ds):
+                repeated += 1
+                continue
+            row = self.score(dc, metric, ds, y)
+            if row is not None:
+                rows.append(row)
+            elif entry is not None and not np.isnan(y):
+                unscored.append(i)   # beyond the cached interval
+        if repeated:
+            print(f"[SKIP] {repeated} readings already scored")
+        return pd.DataFrame(rows, columns=ANOMALY_COLUMNS), points.iloc[unscored].reset_index(drop=True)
+
+    def drifted(self):
+        """Series needing a refit: drift alarm raised or readings beyond the cached horizon."""
+        alarmed = {k for k, e in self.series.items() if abs(e["drift_ewma"]) > DRIFT_LIMIT}
+        return sorted(alarmed | self.stale)
+
+
+# --- Output ---
+def append_anomalies(anomalies: pd.DataFrame, path=ANOMALIES_FILE):
+    """Append flagged readings to forecast_anomalies.csv (header only for a new file)."""
+    if anomalies.empty:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    anomalies[ANOMALY_COLUMNS].to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+# --- Drift-triggered refit ---
+def _to_month_end(readings: pd.DataFrame, metrics):
+    """Collapse a daily feed to one month-end row per site, like Monthly_Validated."""
+    monthly = readings.assign(
+        Reporting_Date=readings["Reporting_Date"].dt.normalize() + pd.offsets.MonthEnd(0)
+    )
+    return monthly.groupby(["Data_Center_Name", "Reporting_Date"], as_index=False)[metrics].mean()
+
+
+def refit(index, readings, series, history_file=ENRICHED_FILE):
+    """Refit only the given (dc, metric) series on history + new readings and refresh their entries."""
+    # Imported here: forecast.py imports this module to build the index nightly
+    from fit_scheduler import FitJob, run_jobs
+    from forecast import forecast_metric
+    from series_store import SeriesStore
+
+    metrics = sorted({m for _, m in series if m in readings.columns})
+    history = pd.read_csv(history_file, parse_dates=["Reporting_Date"])
+    combined = pd.concat([history, _to_month_end(readings, metrics)], ignore_index=True)
+    combined = combined.drop_duplicates(["Data_Center_Name", "Reporting_Date"], keep="last")
+
+    store = SeriesStore.from_frame(combined, metrics)
+    label = f"{INDEX_HORIZON}m"
+    jobs = [
+        FitJob(f"{dc}|{metric}|forecast|{label}", dc, metric, forecast_metric, (metric,),
+               {"periods": INDEX_HORIZON, "horizon_label": label}, kind="forecast", periods=INDEX_HORIZON)
+        for dc, metric in series if (dc, metric) in store.index
+    ]
+    results = run_jobs(store, jobs)
+    index.update(AnomalyIndex.build(store, {(j.dc, j.metric): r.value for j, r in zip(jobs, results)}))
+
+
+# --- Main Online Scoring Process ---
+def main():
+    parser = argparse.ArgumentParser(description="Score new readings against cached forecast intervals.")
+    parser.add_argument("readings", help="CSV with Reporting_Date, Data_Center_Name and metric or raw monthly columns")
+    parser.add_argument("--no-refit", action="store_true", help="only report drifted series, do not refit them")
+    args = parser.parse_args()
+
+    index = AnomalyIndex.load()
+    readings = pd.read_csv(args.readings, parse_dates=["Reporting_Date"])
+
+    # Full Monthly_Validated-style rows are enriched first so derived metrics can be scored;
+    # partial feeds (e.g. daily Avg_IT_Load_kW / Avg_Total_Load_kW) are scored on the metrics they carry
+    missing_metrics = any(m not in readings.columns for _, m in index.series)
+    if missing_metrics and all(c in readings.columns for c in RAW_COLUMNS):
+        from etl import enrich
+        readings = enrich(readings)
+
+    scored, unscored = index.score_frame(readings)
+
+    drifted = index.drifted()
+    if drifted:
+        print(f"Drift detected in {len(drifted)} series: " + ", ".join(f"{dc}/{m}" for dc, m in drifted))
+        if not args.no_refit:
+            refit(index, readings, drifted)
+            print("Refit complete ✅")
+            # Readings beyond the old horizon triggered the refit; score them against the new intervals
+            rescored, unscored = index.score_points(unscored)
+            scored = pd.concat([scored, rescored], ignore_index=True)
+
+    anomalies = scored[scored["Anomaly"]]
+    append_anomalies(anomalies)
+    print(f"Scored {len(scored)} readings, {len(anomalies)} anomalies appended to {ANOMALIES_FILE}")
+    if len(unscored):
+        print(f"[SKIP] {len(unscored)} readings beyond the cached forecast horizon left unscored "
+              "(run without --no-refit, or wait for the nightly refit)")
+
+    index.save()
+
+# Entry point: run main() if script is executed directly
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+energy.py
+---------
+Time-weighted energy and carbon computation from interval meter data.
+
+This module:
+1. Stores hourly / 15-minute facility meter readings and grid carbon-intensity
+   series as memory-mapped columnar files, one directory per data center:
+       data/interval/<DC>/meter_ts.i64          interval start, epoch seconds (sorted)
+       data/interval/<DC>/meter_kw.f64          average facility power over the interval (kW)
+       data/interval/<DC>/carbon_ts.i64         intensity valid-from, epoch seconds (sorted)
+       data/interval/<DC>/carbon_tco2_per_kwh.f64
+2. Integrates kW over each interval's duration (kWh) and multiplies by the grid
+   intensity in force at that time (tCO2), in fixed-size chunks so a full year
+   never has to be loaded into RAM.
+3. Aggregates per site-month and feeds the result back into the enriched
+   Energy_Consumption_kWh / Carbon_Emissions_tCO2 columns (see apply_interval_energy).
+
+Sites without a carbon-intensity series use their static
+Carbon_Factor_tCO2_per_kWh from constants.py.
+
+Usage (load an export before running etl.py; re-running is safe, stored rows are skipped):
+    python src/python/energy.py meter  DC-One meter_export.csv  --ts-col Timestamp --value-col Facility_kW
+    python src/python/energy.py carbon DC-One grid_intensity.csv --ts-col Timestamp --value-col tCO2_per_kWh
+
+Author: Kenneth @ TippleK Data Centres
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from constants import DATA_CENTERS
+
+# --- Project Paths ---
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+INTERVAL_DIR = os.path.join(PROJECT_ROOT, "data/interval")
+
+# --- Column files per series kind ---
+COLUMNS = {
+    "meter": ("meter_ts.i64", "meter_kw.f64"),
+    "carbon": ("carbon_ts.i64", "carbon_tco2_per_kwh.f64"),
+}
+
+CHUNK_ROWS = 1_000_000   # ~16 MB of meter data per chunk
+MIN_COVERAGE = 0.95      # share of the month that interval data must cover to replace the monthly estimate
+GAP_FACTOR = 4           # an interval longer than this many typical steps is a gap in the feed
+
+
+# --- Columnar storage ---
+def _paths(dc, kind, root=INTERVAL_DIR):
+    ts_file, value_file = COLUMNS[kind]
+    return os.path.join(root, dc, ts_file), os.path.join(root, dc, value_file)
+
+
+def _last_timestamp(ts_path):
+    """Last stored timestamp (epoch seconds) read from the file tail, or None for a new file."""
+    if not os.path.exists(ts_path) or os.path.getsize(ts_path) < 8:
+        return None
+    return int(np.fromfile(ts_path, dtype="<i8", count=1, offset=os.path.getsize(ts_path) - 8)[0])
+
+
+def _reconcile(ts_path, value_path):
+    """
+    Truncate both column files to the rows present in both. A crash between the
+    two appends (or a torn write) otherwise leaves them with different lengths.
+    """
+    sizes = [os.path.getsize(p) if os.path.exists(p) else 0 for p in (ts_path, value_path)]
+    rows = min(sizes) // 8
+    for path, size in zip((ts_path, value_path), sizes):
+        if size != rows * 8:
+            print(f"[REPAIR] {path}: truncating {size // 8} to {rows} rows to match its paired column")
+            with open(path, "r+b") as f:
+                f.truncate(rows * 8)
+
+
+def append_columns(dc, kind, timestamps, values, root=INTERVAL_DIR):
+    """
+    Append readings to a site's columnar files and return the number of rows written.
+    timestamps: datetime-like (naive values are taken as UTC), strictly increasing.
+    Rows at or before the last stored timestamp are dropped, so re-running an
+    export or loading an overlapping one does not duplicate or reorder data.
+    """
+    ts = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_localize(None)
+    ts = ts.to_numpy(dtype="datetime64[s]").astype("<i8")
+    vals = np.asarray(values, dtype="<f8")
+    if len(ts) > 1 and not (np.diff(ts) > 0).all():
+        raise ValueError(f"{dc} {kind}: timestamps must be strictly increasing; sort the export first")
+
+    ts_path, value_path = _paths(dc, kind, root)
+    _reconcile(ts_path, value_path)
+    last = _last_timestamp(ts_path)
+    if last is not None:
+        new = ts > last
+        if not new.all():
+            print(f"[SKIP] {dc} {kind}: {int((~new).sum())} readings already stored")
+        ts, vals = ts[new], vals[new]
+    if not len(ts):
+        return 0
+
+    # Values first, timestamps second: the timestamp file decides which rows count as stored
+    os.makedirs(os.path.dirname(ts_path), exist_ok=True)
+    with open(value_path, "ab") as f:
+        f.write(vals.tobytes())
+    with open(ts_path, "ab") as f:
+        f.write(ts.tobytes())
+    return len(ts)
+
+
+def ingest_csv(path, dc, kind, ts_col, value_col, chunksize=CHUNK_ROWS, root=INTERVAL_DIR):
+    """Stream a sorted meter / intensity CSV export into the columnar files; returns rows written."""
+    written = 0
+    for chunk in pd.read_csv(path, usecols=[ts_col, value_col], chunksize=chunksize):
+        written += append_columns(dc, kind, chunk[ts_col], chunk[value_col], root)
+    return written
+
+
+def open_columns(dc, kind, root=INTERVAL_DIR):
+    """Memory-map a site's (timestamps, values) columns; None if the site has no data."""
+    ts_path, value_path = _paths(dc, kind, root)
+    if not os.path.exists(ts_path):
+        return None
+    _reconcile(ts_path, value_path)
+    if not os.path.getsize(ts_path):
+        return None
+    ts = np.memmap(ts_path, dtype="<i8", mode="r")
+    vals = np.memmap(value_path, dtype="<f8", mode="r")
+    return ts, vals
+
+
+def _month_ordinal(epoch_seconds):
+    """Months since 1970-01 for each epoch-second timestamp."""
+    return epoch_seconds.astype("datetime64[s]").astype("datetime64[M]").astype("int64")
+
+
+# --- Energy & Carbon engine ---
+def monthly_energy_carbon(dc, carbon_factor=None, chunk_rows=CHUNK_ROWS, root=INTERVAL_DIR) -> pd.DataFrame:
+    """
+    Time-weighted kWh and tCO2 per month for one site.
+
+    Each reading covers [t_i, t_i+1). Intervals longer than GAP_FACTOR x the
+    chunk's typical step are gaps in the feed: they are cut back to that step,
+    so missing time is not filled by stretching the last reading. Missing (NaN)
+    readings also count as missing time.
+    Returns Month (months since 1970-01), Energy_Consumption_kWh,
+    Carbon_Emissions_tCO2 and Covered_Hours.
+    """
+    meter = open_columns(dc, "meter", root)
+    if meter is None:
+        return pd.DataFrame(columns=["Month", "Energy_Consumption_kWh", "Carbon_Emissions_tCO2", "Covered_Hours"])
+    meter_ts, meter_kw = meter
+    carbon = open_columns(dc, "carbon", root)
+    if carbon_factor is None:
+        carbon_factor = DATA_CENTERS[dc]["Carbon_Factor_tCO2_per_kWh"]
+
+    n = len(meter_ts)
+    first_month = int(_month_ordinal(meter_ts[:1])[0])
+    n_months = int(_month_ordinal(meter_ts[-1:])[0]) - first_month + 1
+    kwh = np.zeros(n_months)
+    tco2 = np.zeros(n_months)
+    hours = np.zeros(n_months)
+
+    step = None
+    for start in range(0, n, chunk_rows):
+        end = min(start + chunk_rows, n)
+        # One extra timestamp so the chunk's last interval has an end
+        ts = np.asarray(meter_ts[start:min(end + 1, n)])
+        kw = np.asarray(meter_kw[start:end])
+
+        dt = np.diff(ts).astype("float64")
+        # Typical step of this chunk (previous chunk's, or hourly, if it has no intervals)
+        step = float(np.median(dt)) if len(dt) else (step or 3600.0)
+        if len(dt) < len(kw):
+            # Final reading of the series: assume the same resolution as the one before it
+            dt = np.append(dt, dt[-1] if len(dt) else step)
+        # Only real gaps are cut back to the typical step; a feed that changes
+        # resolution (e.g. hourly -> 15 min) keeps each reading's own duration
+        dt = np.where(dt > GAP_FACTOR * step, step, dt)
+        ts = ts[:len(kw)]
+
+        valid = ~np.isnan(kw)
+        duration_h = np.where(valid, dt / 3600.0, 0.0)
+        energy = np.where(valid, kw, 0.0) * duration_h
+
+        # Grid intensity in force at each interval start (step function)
+        if carbon is None:
+            intensity = np.full(len(ts), carbon_factor)
+        else:
+            carbon_ts, carbon_val = carbon
+            idx = np.searchsorted(carbon_ts, ts, side="right") - 1
+            intensity = np.asarray(carbon_val[np.clip(idx, 0, None)])
+            intensity = np.where((idx < 0) | np.isnan(intensity), carbon_factor, intensity)
+
+        month = _month_ordinal(ts) - first_month
+        kwh += np.bincount(month, weights=energy, minlength=n_months)
+        tco2 += np.bincount(month, weights=energy * intensity, minlength=n_months)
+        hours += np.bincount(month, weights=duration_h, minlength=n_months)
+
+    covered = hours > 0
+    return pd.DataFrame({
+        "Month": np.arange(first_month, first_month + n_months)[covered],
+        "Energy_Consumption_kWh": kwh[covered],
+        "Carbon_Emissions_tCO2": tco2[covered],
+        "Covered_Hours": hours[covered],
+    })
+
+
+def apply_interval_energy(df: pd.DataFrame, root=INTERVAL_DIR, min_coverage=MIN_COVERAGE) -> pd.DataFrame:
+    """
+    Replace the monthly-average Energy_Consumption_kWh / Carbon_Emissions_tCO2
+    with time-weighted interval values where a site-month is covered well enough.
+    Small gaps are filled pro rata to Hours_in_Month. Energy_Source records
+    which method produced each row ("interval" or "monthly_avg").
+    """
+    df["Energy_Source"] = "monthly_avg"
+
+    frames = []
+    for dc in df["Data_Center_Name"].unique():
+        monthly = monthly_energy_carbon(dc, root=root)
+        if len(monthly):
+            frames.append(monthly.assign(Data_Center_Name=dc))
+    if not frames:
+        return df
+
+    interval = pd.concat(frames, ignore_index=True).set_index(["Data_Center_Name", "Month"])
+    keys = pd.MultiIndex.from_arrays([
+        df["Data_Center_Name"],
+        _month_ordinal(df["Reporting_Date"].to_numpy(dtype="datetime64[s]").astype("int64")),
+    ])
+    matched = interval.reindex(keys)
+
+    covered_hours = matched["Covered_Hours"].to_numpy()
+    month_hours = df["Hours_in_Month"].to_numpy(dtype="float64")
+    use = covered_hours >= min_coverage * month_hours    # NaN (no interval data) compares False
+    scale = np.divide(month_hours, covered_hours, out=np.ones_like(month_hours), where=use)
+
+    df["Energy_Consumption_kWh"] = np.where(
+        use, matched["Energy_Consumption_kWh"].to_numpy() * scale, df["Energy_Consumption_kWh"])
+    df["Carbon_Emissions_tCO2"] = np.where(
+        use, matched["Carbon_Emissions_tCO2"].to_numpy() * scale, df["Carbon_Emissions_tCO2"])
+    df["Energy_Source"] = np.where(use, "interval", "monthly_avg")
+    return df
+
+
+# --- Main Ingest Process ---
+def main():
+    parser = argparse.ArgumentParser(description="Load interval meter / grid carbon-intensity exports for etl.py.")
+    parser.add_argument("kind", choices=sorted(COLUMNS), help="meter (average facility kW) or carbon (tCO2 per kWh)")
+    parser.add_argument("dc", choices=sorted(DATA_CENTERS), help="data center the export belongs to")
+    parser.add_argument("csv", help="CSV export sorted by timestamp")
+    parser.add_argument("--ts-col", default="Timestamp", help="timestamp column (default: Timestamp)")
+    parser.add_argument("--value-col", required=True, help="value column")
+    args = parser.parse_args()
+
+    written = ingest_csv(args.csv, args.dc, args.kind, args.ts_col, args.value_col)
+    print(f"Loaded {written} {args.kind} readings for {args.dc} into {os.path.join(INTERVAL_DIR, args.dc)} ✅")
+
+# Entry point: run main() if script is executed directly
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ Monthly + Forecast ETL pipeline for Colocation Capacity Reporting.
 This script:
 1. Loads Monthly_Raw and Monthly_Validated sheets from the raw Excel file.
 2. Enriches them with calculated metrics (utilization %, IT load %, PUE, contracted load, energy consumption, carbon emissions, etc.).
+   Energy and carbon use time-weighted interval meter data (energy.py) where available.
 3. Merges design constants from constants.py for each data center.
 4. Generates extended Prophet forecasts (120 months horizon) for contracted racks,
    using logistic growth with capacity set to design rack totals.
@@ -18,7 +19,10 @@ import os
 import pandas as pd
 import calendar
 from constants import DATA_CENTERS   # import design metadata (rack density, design capacity, carbon factor, etc.)
-from prophet import Prophet          # forecasting library
+from energy import apply_interval_energy  # time-weighted kWh / tCO2 from interval meter data
+from series_store import SeriesStore # pre-partitioned per-(DC, metric) series
+from fit_scheduler import ETL_FALLBACKS_FILE, FitJob, fallback_flags, run_jobs  # cost-aware fit scheduling with time budgets
+from forecast import forecast_metric # Prophet fit (logistic growth supported) with linear fallback
 
 # --- Project Paths ---
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
@@ -73,6 +77,8 @@ def enrich(df: pd.DataFrame) -> pd.DataFrame:
     df["Hours_in_Month"] = df["Reporting_Date"].apply(lambda d: calendar.monthrange(d.year, d.month)[1] * 24)
     df["Energy_Consumption_kWh"] = df["Facility_Power_kW"] * df["Hours_in_Month"]
     df["Carbon_Emissions_tCO2"] = df["Energy_Consumption_kWh"] * df["Carbon_Factor_tCO2_per_kWh"]
+    # Replace with time-weighted interval values where hourly / 15-min meter data exists
+    df = apply_interval_energy(df)
 
     # --- Ratios & Comparisons ---
     df["Rack_Utilization_vs_Design_%"] = df["Total_Contracted_Racks"] / df["Design_Total_Racks"] * 100
@@ -86,46 +92,53 @@ def enrich(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 # --- Forecast Function with Logistic Growth ---
-def forecast_racks(df: pd.DataFrame) -> pd.DataFrame:
+def forecast_racks(store: SeriesStore):
     """
     Generate a 120-month forecast of Total_Contracted_Racks using Prophet.
     Uses logistic growth with capacity set to design rack totals.
     Produces baseline, lower, and upper confidence intervals.
+    Series are read from a SeriesStore built once per run; fits run through
+    the cost-aware scheduler and fall back to a linear trend on timeout.
+    Returns (forecast, fallbacks): fallbacks has one row per fit that fell back
+    (Data_Center_Name, Metric, Fallback_Jobs such as "forecast|120m:timeout").
     """
 
-    forecasts = []
-    for dc in df["Data_Center_Name"].unique():
-        dc_df = df[df["Data_Center_Name"] == dc][["Reporting_Date", "Total_Contracted_Racks"]].rename(
-            columns={"Reporting_Date": "ds", "Total_Contracted_Racks": "y"}
-        )
-
-        # Add capacity column for logistic growth
-        cap_value = DATA_CENTERS[dc]["Design_Total_Racks"]
-        dc_df["cap"] = cap_value
-
-        # Fit Prophet model with logistic growth
-        model = Prophet(growth="logistic")
-        model.fit(dc_df)
-
-        # Extend horizon to 120 months (10 years)
-        future = model.make_future_dataframe(periods=120, freq="ME")
-        future["cap"] = cap_value
-
-        forecast = model.predict(future)
+    # Logistic growth with capacity set to design rack totals; 120 months (10 years) ahead
+    jobs = [
+        FitJob(f"{dc}|Total_Contracted_Racks|forecast|120m", dc, "Total_Contracted_Racks", forecast_metric,
+               ("Total_Contracted_Racks",),
+               {"periods": 120, "horizon_label": "120m", "growth": "logistic",
+                "cap": DATA_CENTERS[dc]["Design_Total_Racks"]},
+               kind="forecast", growth="logistic", periods=120)
+        for dc in store.data_centers
+    ]
 
-        # Add metadata
-        forecast["Metric"] = "Total_Contracted_Racks"
-        forecast["Horizon"] = "120m"
-        forecast["Data_Center_Name"] = dc
+    results = run_jobs(store, jobs)
+    fallbacks = fallback_flags(jobs, results)
 
-        forecasts.append(forecast[["ds", "yhat", "yhat_lower", "yhat_upper", "Metric", "Horizon", "Data_Center_Name"]])
-
-    return pd.concat(forecasts, ignore_index=True)
+    forecasts = []
+    for job, res in zip(jobs, results):
+        # Add metadata; Model shows whether the fit fell back to the linear trend
+        forecast = res.value
+        forecast["Data_Center_Name"] = job.dc
+        forecast["Model"] = res.model
+        forecasts.append(forecast[["ds", "yhat", "yhat_lower", "yhat_upper", "Metric", "Horizon", "Data_Center_Name", "Model"]])
+
+    fallback_rows = pd.DataFrame(
+        [{"Data_Center_Name": dc, "Metric": metric, "Fallback_Jobs": entry}
+         for (dc, metric), entries in fallbacks.items() for entry in entries],
+        columns=["Data_Center_Name", "Metric", "Fallback_Jobs"],
+    )
+    return pd.concat(forecasts, ignore_index=True), fallback_rows
 
 # --- Main ETL Process ---
 def main():
     print("Starting ETL pipeline...")
 
+    # Drop last run's fallback flags so forecast.py never merges a stale file
+    if os.path.exists(ETL_FALLBACKS_FILE):
+        os.remove(ETL_FALLBACKS_FILE)
+
     # 1. Load Monthly Sheets from Excel
     print("Loading raw Excel file...")
     df_raw = pd.read_excel(RAW_FILE, sheet_name="Monthly_Raw")
@@ -142,12 +155,14 @@ def main():
 
     # 4. Generate extended forecast (120 months, logistic growth)
     print("Generating 120-month forecast with logistic growth...")
-    df_forecast = forecast_racks(df_validated)
+    store = SeriesStore.from_frame(df_validated_enriched, ["Total_Contracted_Racks"])
+    df_forecast, df_fallbacks = forecast_racks(store)
 
-    # 5. Export forecast dataset
+    # 5. Export forecast dataset (+ fallback flags, merged into forecast_quality.csv by forecast.py)
     print(f"Exporting forecast dataset to {FORECAST_FILE}...")
     os.makedirs(os.path.dirname(FORECAST_FILE), exist_ok=True)
     df_forecast.to_csv(FORECAST_FILE, index=False)
+    df_fallbacks.to_csv(ETL_FALLBACKS_FILE, index=False)
 
     print("ETL pipeline complete ✅")
 
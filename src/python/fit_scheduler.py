@@ -0,0 +1,289 @@
+"""
+fit_scheduler.py
+----------------
+Cost-aware scheduler for Prophet fits with per-fit time budgets and fallback models.
+
+This module:
+1. Estimates the cost of every fit job from previous runs (data/processed/fit_costs.json),
+   falling back to a size x growth-mode prior for jobs never seen before.
+2. Runs the most expensive jobs first (longest-processing-time order) on a
+   bounded set of worker processes, so one long series cannot end the run alone.
+3. Enforces a per-fit time budget: a job that overruns is terminated and re-run
+   in-process with the cheap linear model (model="linear"), and flagged.
+4. Pins BLAS / OpenMP / Stan threads per worker to avoid oversubscription.
+
+Job functions take a 'ds'/'y' frame as first argument and accept model="linear"
+as their cheap fallback (see forecast.forecast_metric / evaluate_forecast / detect_anomalies).
+
+Author: Kenneth @ TippleK Data Centres
+"""
+
+import json
+import multiprocessing as mp
+import os
+import signal
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from multiprocessing.connection import wait
+
+from series_store import SeriesStore
+
+# --- Project Paths ---
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
+COST_HISTORY_FILE = os.path.join(PROJECT_ROOT, "data/processed/fit_costs.json")
+# Fallbacks of etl.py's 120-month rack forecasts (Data_Center_Name, Metric, Fallback_Jobs),
+# merged into the matching forecast_quality.csv rows by forecast.py
+ETL_FALLBACKS_FILE = os.path.join(PROJECT_ROOT, "data/forecast/forecast_racks_fallbacks.csv")
+
+# --- Cost model defaults ---
+DEFAULT_SECONDS_PER_POINT = 0.02     # prior for unseen jobs (Prophet fit + predict per input/output row)
+GROWTH_WEIGHT = {"linear": 1.0, "flat": 0.5, "logistic": 3.0}
+COST_SMOOTHING = 0.3                 # EWMA weight given to the newest observed duration
+
+# --- Time budget defaults ---
+MIN_BUDGET_SECONDS = 30              # never cut a fit shorter than this
+BUDGET_FACTOR = 5                    # budget = factor x estimated cost ...
+MAX_BUDGET_SECONDS = 300             # ... capped so the nightly makespan stays bounded
+
+# Environment variables read by BLAS / OpenMP / CmdStan thread pools
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "STAN_NUM_THREADS",
+]
+
+
+@dataclass
+class FitJob:
+    """One fit: func(store.frame(dc, metric), *args, **kwargs)."""
+    key: str                      # stable id used for cost history, e.g. "DC-One|PUE_vs_Target|forecast|12m"
+    dc: str
+    metric: str
+    func: object                  # module-level function (must be picklable)
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    kind: str = "forecast"        # forecast / evaluate / anomalies
+    growth: str = "linear"        # Prophet growth mode, drives the cost prior
+    periods: int = 0              # future rows predicted, adds to job size
+
+
+@dataclass
+class FitResult:
+    """Outcome of one FitJob."""
+    key: str
+    value: object
+    model: str                    # "prophet" or "linear"
+    status: str                   # "ok", "timeout" or "error"
+    seconds: float
+    estimate: float
+    budget: float
+
+    @property
+    def fallback(self):
+        return self.status != "ok"
+
+
+def fallback_flags(jobs, results):
+    """{(dc, metric): ["<task>:<status>", ...]} for every job that fell back, e.g. "forecast|12m:timeout"."""
+    flags = {}
+    for job, res in zip(jobs, results):
+        if res.fallback:
+            flags.setdefault((job.dc, job.metric), []).append(f"{job.key.split('|', 2)[2]}:{res.status}")
+    return flags
+
+
+# --- Cost history ---
+def load_cost_history(path=COST_HISTORY_FILE):
+    """
+    Load {"jobs": {key: seconds}, "rates": {kind|growth: seconds_per_point},
+          "timeouts": {key: seconds}}.
+    jobs/rates hold successful fits only and drive the time budget; timeouts holds
+    lower bounds for jobs that overran, used only to start them first.
+    """
+    if not os.path.exists(path):
+        return {"jobs": {}, "rates": {}, "timeouts": {}}
+    with open(path) as f:
+        history = json.load(f)
+    for section in ("jobs", "rates", "timeouts"):
+        history.setdefault(section, {})
+    return history
+
+
+def save_cost_history(history, path=COST_HISTORY_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+
+
+def _ewma(old, new):
+    return new if old is None else (1 - COST_SMOOTHING) * old + COST_SMOOTHING * new
+
+
+def estimate_cost(job, size, history):
+    """Estimated seconds for a job: its own successful runs, else a per-point rate, else the prior."""
+    if job.key in history["jobs"]:
+        return history["jobs"][job.key]
+    points = max(size + job.periods, 1)
+    rate = history["rates"].get(f"{job.kind}|{job.growth}")
+    if rate is None:
+        rate = DEFAULT_SECONDS_PER_POINT * GROWTH_WEIGHT.get(job.growth, 1.0)
+    return rate * points
+
+
+def time_budget(estimate):
+    return min(MAX_BUDGET_SECONDS, max(MIN_BUDGET_SECONDS, BUDGET_FACTOR * estimate))
+
+
+def _order_cost(job, estimate, history):
+    """Scheduling weight: a past timeout is a lower bound on the job's true cost."""
+    return max(estimate, history["timeouts"].get(job.key, 0.0))
+
+
+def _record_cost(history, job, size, seconds):
+    """Record a successful fit; it also clears any earlier timeout for the job."""
+    history["timeouts"].pop(job.key, None)
+    history["jobs"][job.key] = _ewma(history["jobs"].get(job.key), seconds)
+    rate_key = f"{job.kind}|{job.growth}"
+    history["rates"][rate_key] = _ewma(history["rates"].get(rate_key), seconds / max(size + job.periods, 1))
+
+
+# --- Thread pinning ---
+@contextmanager
+def _thread_env(threads):
+    """Temporarily set thread-pool env vars so a spawned worker inherits them."""
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _pin_threads(threads):
+    """Pin thread pools inside a worker (covers forked workers and CmdStan subprocesses)."""
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        from threadpoolctl import threadpool_limits   # optional: limits pools already loaded by numpy
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+# --- Worker ---
+def _run_job(conn, handle, job, threads):
+    """Worker entry point: attach to the shared store, run one fit, send the result back."""
+    # Own process group, so a timeout also kills the CmdStan optimizer Prophet spawns
+    os.setpgrp()
+    _pin_threads(threads)
+    try:
+        store = SeriesStore.attach(handle)
+        ts = store.frame(job.dc, job.metric)
+        conn.send(("ok", job.func(ts, *job.args, **job.kwargs)))
+    except Exception as e:   # report any failure so the parent can fall back
+        conn.send(("error", repr(e)))
+    finally:
+        conn.close()
+
+
+def _run_fallback(store, job):
+    """Cheap model, run in-process so it cannot be held up by the pool."""
+    ts = store.frame(job.dc, job.metric)
+    return job.func(ts, *job.args, **{**job.kwargs, "model": "linear"})
+
+
+def _kill_worker(proc):
+    """SIGKILL the worker and every child in its process group (e.g. CmdStan)."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        proc.kill()   # exited already, or killed before it reached os.setpgrp()
+    proc.join()
+
+
+# --- Scheduler ---
+def run_jobs(store: SeriesStore, jobs, workers=None, history_path=COST_HISTORY_FILE):
+    """
+    Run every FitJob against the store and return FitResults in job order.
+    Longest estimated jobs start first; overrunning or failing fits are
+    replaced by the linear fallback and marked with status "timeout"/"error".
+    """
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    history = load_cost_history(history_path)
+
+    sizes = {job.key: store.index[(job.dc, job.metric)][1] for job in jobs}
+    estimates = {job.key: estimate_cost(job, sizes[job.key], history) for job in jobs}
+
+    # Longest-processing-time first keeps the makespan close to the optimum
+    pending = sorted(jobs, key=lambda j: _order_cost(j, estimates[j.key], history), reverse=True)
+    running = {}   # key -> (job, process, connection, start, budget)
+    results = {}
+
+    def finish(job, value, model, status, seconds, budget):
+        results[job.key] = FitResult(job.key, value, model, status, seconds, estimates[job.key], budget)
+        if status == "ok":
+            _record_cost(history, job, sizes[job.key], seconds)
+        elif status == "timeout":
+            # Lower bound only: keeps the job at the front of the queue next run without
+            # inflating its budget or the shared per-point rate
+            history["timeouts"][job.key] = max(seconds, history["timeouts"].get(job.key, 0.0))
+        if status != "ok":
+            print(f"[FALLBACK] {job.key}: {status} after {seconds:.1f}s, using linear model")
+
+    handle = store.share()
+    try:
+        while pending or running:
+            # Fill free worker slots
+            while pending and len(running) < workers:
+                job = pending.pop(0)
+                budget = time_budget(estimates[job.key])
+                parent_conn, child_conn = mp.Pipe(duplex=False)
+                with _thread_env(threads):
+                    proc = mp.Process(target=_run_job, args=(child_conn, handle, job, threads), daemon=True)
+                    proc.start()
+                child_conn.close()
+                running[job.key] = (job, proc, parent_conn, time.monotonic(), budget)
+
+            # Sleep until a result arrives, a worker dies or the nearest budget expires
+            now = time.monotonic()
+            next_deadline = min(start + budget for _, _, _, start, budget in running.values())
+            wait([conn for _, _, conn, _, _ in running.values()], timeout=max(0.0, next_deadline - now))
+
+            for key in list(running):
+                job, proc, conn, start, budget = running[key]
+                elapsed = time.monotonic() - start
+                if conn.poll():
+                    try:
+                        status, value = conn.recv()
+                    except EOFError:
+                        status, value = "error", "worker exited without a result"
+                    proc.join()
+                elif elapsed > budget:
+                    _kill_worker(proc)
+                    status, value = "timeout", None
+                    elapsed = budget
+                else:
+                    continue
+
+                conn.close()
+                del running[key]
+                if status == "ok":
+                    finish(job, value, "prophet", "ok", elapsed, budget)
+                else:
+                    finish(job, _run_fallback(store, job), "linear", status, elapsed, budget)
+    finally:
+        for job, proc, conn, _, _ in running.values():
+            _kill_worker(proc)
+            conn.close()
+        store.close(unlink=True)
+        save_cost_history(history, history_path)
+
+    return [results[job.key] for job in jobs]
@@ -7,25 +7,89 @@ from sklearn.metrics import (                # Accuracy metrics for evaluating f
 )
 import numpy as np                           # For numerical operations (e.g., sqrt)
 import os                                    # For file/directory handling
+from statistics import NormalDist            # For interval z-scores of the linear fallback
+from series_store import SeriesStore         # Pre-partitioned per-(DC, metric) series
+from fit_scheduler import (                  # Cost-aware scheduling with time budgets
+    ETL_FALLBACKS_FILE,
+    FitJob,
+    fallback_flags,
+    run_jobs
+)
+from anomaly_index import (                  # Online anomaly scoring index (rebuilt each run)
+    ANOMALY_COLUMNS,
+    INDEX_HORIZON,
+    AnomalyIndex,
+    severity
+)
 
 # -----------------------------
-# Function: forecast_metric
-# Purpose: Forecast a given metric for a given horizon
+# Function: linear_forecast
+# Purpose: Cheap fallback model — least-squares trend with a residual-based interval.
+#          Returns the same columns as Prophet's predict() for history + future dates.
 # -----------------------------
-def forecast_metric(df, metric, periods=12, horizon_label="12m"):
-    # Prepare dataset: Prophet requires 'ds' (date) and 'y' (value)
-    ts = df[["Reporting_Date", metric]].rename(columns={"Reporting_Date": "ds", metric: "y"})
-    ts = ts.dropna()  # Remove rows with missing values
+def linear_forecast(ts, periods=0, cap=None, interval_width=0.8):
+    history = pd.DatetimeIndex(ts["ds"])
+    y = ts["y"].to_numpy(dtype="float64")
+    n = len(y)
+
+    # Future month-ends, built the same way as Prophet's make_future_dataframe
+    future = pd.DatetimeIndex([])
+    if n and periods:
+        future = pd.date_range(start=history[-1], periods=periods + 1, freq="ME")
+        future = future[future > history[-1]][:periods]
+    ds = history.append(future)
+
+    # Fit trend on day offsets from the first observation
+    x = ((ds - ds[0]) / pd.Timedelta(days=1)).to_numpy(dtype="float64") if len(ds) else np.empty(0)
+    if n >= 2:
+        slope, intercept = np.polyfit(x[:n], y, 1)
+        yhat = intercept + slope * x
+    else:
+        yhat = np.full(len(ds), y[0] if n else np.nan)
+
+    # Interval width from in-sample residual spread
+    sigma = np.std(y - yhat[:n]) if n else np.nan
+    half_width = NormalDist().inv_cdf(0.5 + interval_width / 2) * sigma
+    yhat_lower, yhat_upper = yhat - half_width, yhat + half_width
+
+    # Respect logistic capacity bounds (floor 0, ceiling cap) like Prophet's logistic growth
+    if cap is not None:
+        yhat, yhat_lower, yhat_upper = (np.clip(a, 0, cap) for a in (yhat, yhat_lower, yhat_upper))
+
+    return pd.DataFrame({"ds": ds, "yhat": yhat, "yhat_lower": yhat_lower, "yhat_upper": yhat_upper})
+
+# -----------------------------
+# Function: fit_predict
+# Purpose: Fit a model on ts and predict history + `periods` future month-ends.
+#          model="prophet" (default) or "linear" (cheap fallback used by the scheduler).
+#          growth="logistic" requires cap (design capacity).
+# -----------------------------
+def fit_predict(ts, periods=0, model="prophet", growth="linear", cap=None):
+    if model == "linear":
+        return linear_forecast(ts, periods=periods, cap=cap)
+
+    # Logistic growth needs a capacity column on both history and future
+    train = ts.assign(cap=cap) if cap is not None else ts
 
     # Initialize and fit Prophet model
-    model = Prophet()
-    model.fit(ts)
+    m = Prophet(growth=growth)
+    m.fit(train)
 
     # Create future dates (monthly frequency, 'ME' = month-end)
-    future = model.make_future_dataframe(periods=periods, freq="ME")
+    future = m.make_future_dataframe(periods=periods, freq="ME")
+    if cap is not None:
+        future["cap"] = cap
 
     # Generate forecast
-    forecast = model.predict(future)
+    return m.predict(future)
+
+# -----------------------------
+# Function: forecast_metric
+# Purpose: Forecast a given metric for a given horizon
+# Input: ts = 'ds'/'y' frame from SeriesStore.frame() (sorted, no missing values)
+# -----------------------------
+def forecast_metric(ts, metric, periods=12, horizon_label="12m", model="prophet", growth="linear", cap=None):
+    forecast = fit_predict(ts, periods=periods, model=model, growth=growth, cap=cap)
 
     # Extract relevant forecast columns
     result = forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]].copy()
@@ -37,12 +101,9 @@ def forecast_metric(df, metric, periods=12, horizon_label="12m"):
 # -----------------------------
 # Function: evaluate_forecast
 # Purpose: Calculate forecast accuracy metrics (MAPE, RMSE)
+# Input: ts = 'ds'/'y' frame from SeriesStore.frame()
 # -----------------------------
-def evaluate_forecast(df, metric):
-    # Prepare dataset
-    ts = df[["Reporting_Date", metric]].dropna()
-    ts = ts.rename(columns={"Reporting_Date": "ds", metric: "y"})
-
+def evaluate_forecast(ts, metric, model="prophet"):
     # Skip evaluation if dataset is too short (<6 months)
     if len(ts) < 6:
         print(f"[SKIP] Not enough data to evaluate forecast for {metric}")
@@ -52,13 +113,8 @@ def evaluate_forecast(df, metric):
     train = ts.iloc[:-3]
     test = ts.iloc[-3:]
 
-    # Fit Prophet on training data
-    model = Prophet()
-    model.fit(train)
-
-    # Forecast next 3 months
-    future = model.make_future_dataframe(periods=3, freq="ME")
-    forecast = model.predict(future)
+    # Fit on training data and forecast next 3 months
+    forecast = fit_predict(train, periods=3, model=model)
 
     # Merge forecast with test set on 'ds' (safe alignment)
     merged = test.merge(forecast[["ds", "yhat"]], on="ds", how="inner")
@@ -81,24 +137,19 @@ def evaluate_forecast(df, metric):
 # -----------------------------
 # Function: detect_anomalies
 # Purpose: Flag deviations between actuals and forecast
+# Input: ts = 'ds'/'y' frame from SeriesStore.frame()
 # -----------------------------
-def detect_anomalies(df, metric):
-    # Prepare dataset
-    ts = df[["Reporting_Date", metric]].dropna()
-    ts = ts.rename(columns={"Reporting_Date": "ds", metric: "y"})
-
-    # Fit Prophet on full dataset
-    model = Prophet()
-    model.fit(ts)
-
-    # Forecast values for existing dates
-    forecast = model.predict(ts[["ds"]])
+def detect_anomalies(ts, metric, model="prophet"):
+    # Fit on full dataset and forecast values for existing dates
+    forecast = fit_predict(ts, periods=0, model=model)
 
     # Merge actuals with forecast
     merged = ts.merge(forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]], on="ds")
 
     # Flag anomalies: actual outside confidence interval
     merged["Anomaly"] = (merged["y"] < merged["yhat_lower"]) | (merged["y"] > merged["yhat_upper"])
+    # Severity: distance from forecast in interval half-widths (> 1 = outside interval)
+    merged["Severity"] = severity(merged["y"], merged["yhat"], merged["yhat_lower"], merged["yhat_upper"])
     anomalies = merged[merged["Anomaly"]]
     anomalies["Metric"] = metric
     return anomalies
@@ -125,31 +176,69 @@ def main():
         "Rack_Utilization_vs_Design_%"
     ]
 
-    # Horizons: short (6m), medium (12m), long (24m)
-    horizons = [(6, "6m"), (12, "12m"), (24, "24m")]
+    # Horizons: short (6m), medium (12m), long (24m — also cached for online anomaly scoring)
+    horizons = [(6, "6m"), (12, "12m"), (INDEX_HORIZON, f"{INDEX_HORIZON}m")]
 
-    # Loop through each data center
-    for dc in df["Data_Center_Name"].unique():
-        dc_df = df[df["Data_Center_Name"] == dc]
+    # Partition once: contiguous per-(DC, metric) series shared by every task
+    store = SeriesStore.from_frame(df, metrics_to_forecast)
 
-        # Loop through each metric
+    # One fit job per (DC, metric, task); the scheduler orders them by estimated cost
+    jobs = []
+    for dc in store.data_centers:
         for metric in metrics_to_forecast:
+            prefix = f"{dc}|{metric}"
             # Forecast for multiple horizons
             for periods, label in horizons:
-                fc = forecast_metric(dc_df, metric, periods=periods, horizon_label=label)
-                fc["Data_Center_Name"] = dc
-                results.append(fc)
-
+                jobs.append(FitJob(f"{prefix}|forecast|{label}", dc, metric, forecast_metric, (metric,),
+                                   {"periods": periods, "horizon_label": label}, kind="forecast", periods=periods))
             # Evaluate forecast quality
-            quality = evaluate_forecast(dc_df, metric)
-            quality["Data_Center_Name"] = dc
-            quality_results.append(quality)
-
+            jobs.append(FitJob(f"{prefix}|evaluate", dc, metric, evaluate_forecast, (metric,),
+                               kind="evaluate", periods=3))
             # Detect anomalies
-            anomalies = detect_anomalies(dc_df, metric)
-            anomalies["Data_Center_Name"] = dc
+            jobs.append(FitJob(f"{prefix}|anomalies", dc, metric, detect_anomalies, (metric,), kind="anomalies"))
+
+    fit_results = run_jobs(store, jobs)
+
+    # Collect outputs; any job that fell back is flagged on its (DC, metric) quality row
+    fallbacks = fallback_flags(jobs, fit_results)
+    for job, res in zip(jobs, fit_results):
+        if job.kind == "forecast":
+            fc = res.value
+            fc["Data_Center_Name"] = job.dc
+            fc["Model"] = res.model
+            results.append(fc)
+        elif job.kind == "evaluate":
+            quality = res.value
+            quality["Data_Center_Name"] = job.dc
+            quality_results.append(quality)
+        else:
+            anomalies = res.value
+            anomalies["Data_Center_Name"] = job.dc
             anomalies_results.append(anomalies)
 
+    # Cache the long-horizon intervals + residual stats for online scoring (anomaly_index.py)
+    index_forecasts = {
+        (job.dc, job.metric): res.value
+        for job, res in zip(jobs, fit_results)
+        if job.kind == "forecast" and job.periods == INDEX_HORIZON
+    }
+    AnomalyIndex.build(store, index_forecasts).save()
+
+    # The ETL's 120-month rack fits are flagged on the same (DC, metric) rows,
+    # but only when etl.py wrote its file in this pipeline run (after enriched_monthly.csv)
+    if os.path.exists(ETL_FALLBACKS_FILE):
+        if os.path.getmtime(ETL_FALLBACKS_FILE) >= os.path.getmtime("data/enriched/enriched_monthly.csv"):
+            etl_fallbacks = pd.read_csv(ETL_FALLBACKS_FILE)
+            for dc, metric, entry in etl_fallbacks[["Data_Center_Name", "Metric", "Fallback_Jobs"]].itertuples(index=False):
+                fallbacks.setdefault((dc, metric), []).append(entry)
+        else:
+            print(f"[SKIP] Ignoring stale {ETL_FALLBACKS_FILE} (older than enriched_monthly.csv)")
+
+    for quality in quality_results:
+        flagged = fallbacks.get((quality["Data_Center_Name"], quality["Metric"]), [])
+        quality["Fallback"] = bool(flagged)
+        quality["Fallback_Jobs"] = ";".join(flagged)
+
     # Save forecasts
     final_fc = pd.concat(results)
     os.makedirs("data/processed", exist_ok=True)  # Ensure output folder exists
@@ -161,7 +250,7 @@ def main():
 
     # Save anomalies
     if anomalies_results:
-        anomalies_df = pd.concat(anomalies_results)
+        anomalies_df = pd.concat(anomalies_results)[ANOMALY_COLUMNS]
         anomalies_df.to_csv("data/processed/forecast_anomalies.csv", index=False)
 
 # Entry point: run main() if script is executed directly
@@ -0,0 +1,159 @@
+"""
+series_store.py
+---------------
+Pre-partitioned series store shared by all forecasting tasks.
+
+This module:
+1. Sorts the enriched monthly frame ONCE by (Data_Center_Name, Reporting_Date).
+2. Packs every (data center, metric) series into one contiguous value buffer
+   and one contiguous date buffer, with missing values already dropped.
+3. Hands out zero-copy, read-only views of those buffers to fitting,
+   evaluation and anomaly code (no per-site boolean masks, no repeated dropna).
+4. Can publish the buffers through shared memory so worker processes attach
+   read-only without pickling the frame.
+
+Author: Kenneth @ TippleK Data Centres
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+class SeriesStore:
+    """
+    Contiguous per-(DC, metric) series with their date index.
+
+    Layout:
+      dates  -> datetime64[ns] buffer, all series back to back
+      values -> float64 buffer, aligned with dates
+      index  -> {(dc, metric): (offset, length)}
+    """
+
+    def __init__(self, dates, values, index, data_centers, metrics):
+        self.dates = dates
+        self.values = values
+        self.index = index
+        self.data_centers = list(data_centers)   # first-appearance order, as df["Data_Center_Name"].unique()
+        self.metrics = list(metrics)
+        self._shm = []                            # shared memory blocks owned / attached by this store
+        self._attached = False                    # True when dates/values live inside shared memory
+
+        # Views handed out must never mutate the shared buffers
+        self.dates.flags.writeable = False
+        self.values.flags.writeable = False
+
+    # --- Construction ---
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, metrics, date_col="Reporting_Date", dc_col="Data_Center_Name"):
+        """
+        Build the store from an enriched frame in a single O(N log N) pass.
+        Sites are grouped by sorting, so preparation time no longer grows
+        with (number of sites x number of rows).
+        """
+        # Factorize keeps first-appearance order of data centers
+        codes, data_centers = pd.factorize(df[dc_col])
+        dates = df[date_col].to_numpy(dtype="datetime64[ns]")
+
+        # One stable sort by (DC code, date) for the whole frame
+        order = np.lexsort((dates, codes))
+        codes = codes[order]
+        dates = dates[order]
+        group_ids = np.arange(len(data_centers))
+
+        date_parts, value_parts, index = [], [], {}
+        offset = 0
+        for metric in metrics:
+            col = df[metric].to_numpy(dtype="float64")[order]
+
+            # Drop missing values once per metric instead of once per task
+            valid = ~np.isnan(col)
+            metric_codes = codes[valid]
+            date_parts.append(dates[valid])
+            value_parts.append(col[valid])
+
+            # Codes are sorted, so each site is a contiguous run
+            starts = np.searchsorted(metric_codes, group_ids, side="left")
+            ends = np.searchsorted(metric_codes, group_ids, side="right")
+            for code, dc in enumerate(data_centers):
+                index[(dc, metric)] = (offset + int(starts[code]), int(ends[code] - starts[code]))
+            offset += len(metric_codes)
+
+        all_dates = np.concatenate(date_parts) if date_parts else np.empty(0, dtype="datetime64[ns]")
+        all_values = np.concatenate(value_parts) if value_parts else np.empty(0, dtype="float64")
+        return cls(all_dates, all_values, index, data_centers, metrics)
+
+    # --- Zero-copy access ---
+    def series(self, dc, metric):
+        """Return (dates, values) read-only views for one (DC, metric) series."""
+        offset, length = self.index[(dc, metric)]
+        return self.dates[offset:offset + length], self.values[offset:offset + length]
+
+    def frame(self, dc, metric) -> pd.DataFrame:
+        """
+        Return the series as a Prophet-ready 'ds'/'y' frame backed by the
+        store buffers (no copy is taken here).
+        """
+        ds, y = self.series(dc, metric)
+        return pd.DataFrame({"ds": ds, "y": y}, copy=False)
+
+    def __len__(self):
+        return len(self.index)
+
+    # --- Shared memory ---
+    def share(self):
+        """
+        Copy the buffers into shared memory and return a small picklable
+        handle that worker processes pass to SeriesStore.attach().
+        The caller keeps this store alive and calls close(unlink=True) when done.
+        """
+        handle = {
+            "index": self.index,
+            "data_centers": self.data_centers,
+            "metrics": self.metrics,
+            "length": len(self.values),
+        }
+        for name, buf in (("dates", self.dates.view("int64")), ("values", self.values)):
+            shm = shared_memory.SharedMemory(create=True, size=max(buf.nbytes, 1))
+            np.ndarray(buf.shape, dtype=buf.dtype, buffer=shm.buf)[:] = buf
+            self._shm.append(shm)
+            handle[f"{name}_shm"] = shm.name
+        return handle
+
+    @classmethod
+    def attach(cls, handle):
+        """Attach read-only to a store published with share()."""
+        length = handle["length"]
+        dates_shm = _open_shared(handle["dates_shm"])
+        values_shm = _open_shared(handle["values_shm"])
+        dates = np.ndarray((length,), dtype="int64", buffer=dates_shm.buf).view("datetime64[ns]")
+        values = np.ndarray((length,), dtype="float64", buffer=values_shm.buf)
+        store = cls(dates, values, handle["index"], handle["data_centers"], handle["metrics"])
+        store._shm = [dates_shm, values_shm]
+        store._attached = True
+        return store
+
+    def close(self, unlink=False):
+        """Release shared memory; the publishing process passes unlink=True."""
+        # An attached store must drop its views into the blocks before closing them
+        if self._attached:
+            self.dates = self.dates[:0].copy()
+            self.values = self.values[:0].copy()
+            self._attached = False
+        for shm in self._shm:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        self._shm = []
+
+
+def _open_shared(name):
+    """
+    Open an existing shared memory block without registering it with this
+    process's resource tracker (the publisher owns and unlinks it).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)   # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)